@@ -1,13 +1,28 @@
-import base64
+import asyncio
+import functools
+import hashlib
 import io
+import json
+import mimetypes
+import os
 import re
+import shelve
+import threading
 import zipfile
-from typing import Dict, Any, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Any, List, Optional, Tuple
 
+import aiohttp
+import orjson
 import pandas as pd
 import requests
 import streamlit as st
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import retry, stop_after_attempt, stop_after_delay, wait_exponential, retry_if_exception
+
+# Regex usate a ogni riga/chiamata: compilate una volta sola
+_PROTO_RE = re.compile(r"^https?://", re.I)
+_NONALNUM_RE = re.compile(r"[^a-zA-Z0-9-]+")
+_DASHES_RE = re.compile(r"-+")
 
 # --- robust slugify import with fallback ---
 try:
@@ -16,8 +31,13 @@ except Exception:
     import unicodedata
     def slugify(value):
         value = unicodedata.normalize("NFKD", str(value)).encode("ascii", "ignore").decode("ascii")
-        value = re.sub(r"[^a-zA-Z0-9-]+", "-", str(value).lower()).strip("-")
-        return re.sub(r"-+", "-", value)
+        value = _NONALNUM_RE.sub("-", str(value).lower()).strip("-")
+        return _DASHES_RE.sub("-", value)
+
+@functools.lru_cache(maxsize=8192)
+def _slug(value: str) -> str:
+    # slugify è una funzione pura: i titoli ripetuti non rifanno NFKD + regex
+    return slugify(value)
 
 # -----------------------
 # Config & Helpers
@@ -30,7 +50,7 @@ API_VERSION   = st.secrets.get("API_VERSION", "2024-07")
 
 def normalize_store_host(s: str) -> str:
     s = (s or "").strip()
-    s = re.sub(r"^https?://", "", s, flags=re.I)  # remove protocol
+    s = _PROTO_RE.sub("", s)  # remove protocol
     s = s.replace("/admin", "")
     s = s.strip("/")
     return s
@@ -49,13 +69,17 @@ if not SHOPIFY_TOKEN:
 
 API_BASE = f"https://{SHOPIFY_STORE}/admin/api/{API_VERSION}"
 
-# ---- Requests session with retry + bigger timeouts ----
-from requests.adapters import HTTPAdapter, Retry
+# ---- Requests session: pool sizing + bigger timeouts (retry only via tenacity, see shopify_retry) ----
+from requests.adapters import HTTPAdapter
 session = requests.Session()
-retries = Retry(total=5, backoff_factor=0.8, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET","POST","PUT"])
-session.mount("https://", HTTPAdapter(max_retries=retries))
+adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, pool_block=False)
+session.mount("https://", adapter)
 DEFAULT_TIMEOUT = (10, 180)  # (connect, read) seconds
 
+# Cache su disco dei prodotti già creati: un nuovo run dopo un errore non ricrea i duplicati.
+# Valori: {"product_id": id, "images": [filename già allegati]}; la chiave include lo store.
+CACHE_PATH = ".shopify_cache.db"
+
 HEADERS = {
     "X-Shopify-Access-Token": SHOPIFY_TOKEN,
     "Content-Type": "application/json",
@@ -63,28 +87,77 @@ HEADERS = {
 }
 
 class ShopifyError(Exception):
-    pass
+    # status: codice HTTP della risposta (None = errore di rete/timeout); retry_after: secondi da Retry-After
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+def is_retryable(e: BaseException) -> bool:
+    # solo throttling, 5xx ed errori di rete: un 422 di validazione non cambia riprovando
+    return isinstance(e, ShopifyError) and (e.status is None or e.status == 429 or e.status >= 500)
+
+_backoff = wait_exponential(multiplier=1, min=2, max=20)
+
+def wait_shopify(retry_state) -> float:
+    # su 429 rispetto il Retry-After di Shopify, altrimenti backoff esponenziale
+    e = retry_state.outcome.exception()
+    if isinstance(e, ShopifyError) and e.retry_after is not None:
+        return e.retry_after
+    return _backoff(retry_state)
+
+# Unico livello di retry: tenacity, 4 tentativi, nessun nuovo tentativo dopo 60 s dalla prima chiamata
+shopify_retry = retry(
+    reraise=True,
+    stop=stop_after_attempt(4) | stop_after_delay(60),
+    wait=wait_shopify,
+    retry=retry_if_exception(is_retryable),
+)
 
+@shopify_retry
 def api_get(path: str) -> Dict[str, Any]:
     url = f"{API_BASE}{path}"
-    resp = session.get(url, headers=HEADERS, timeout=DEFAULT_TIMEOUT)
+    try:
+        resp = session.get(url, headers=HEADERS, timeout=DEFAULT_TIMEOUT)
+    except requests.RequestException as e:
+        raise ShopifyError(f"GET {path} -> {e!r}") from e
     if resp.status_code >= 400:
-        raise ShopifyError(f"GET {path} -> {resp.status_code}: {resp.text}")
-    return resp.json()
+        raise ShopifyError(f"GET {path} -> {resp.status_code}: {resp.text}", resp.status_code,
+                           parse_retry_after(resp.headers.get("Retry-After")))
+    return orjson.loads(resp.content)
 
-def api_post(path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
-    url = f"{API_BASE}{path}"
-    resp = session.post(url, headers=HEADERS, json=payload, timeout=DEFAULT_TIMEOUT)
-    if resp.status_code >= 400:
-        raise ShopifyError(f"POST {path} -> {resp.status_code}: {resp.text}")
-    return resp.json()
+# ---- aiohttp: pipeline asincrona per l'upload (I/O-bound) ----
+MAX_CONCURRENCY = 16  # righe CSV elaborate in parallelo
+IMAGE_WORKERS = 8  # worker che allegano le immagini (producer-consumer)
+IMAGE_QUEUE_SIZE = 128  # prodotti con immagini in attesa prima di rallentare la creazione prodotti
+AIOHTTP_TIMEOUT = aiohttp.ClientTimeout(sock_connect=DEFAULT_TIMEOUT[0], sock_read=DEFAULT_TIMEOUT[1])
 
-def api_put(path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+async def api_post_async(client: aiohttp.ClientSession, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
     url = f"{API_BASE}{path}"
-    resp = session.put(url, headers=HEADERS, json=payload, timeout=DEFAULT_TIMEOUT)
-    if resp.status_code >= 400:
-        raise ShopifyError(f"PUT {path} -> {resp.status_code}: {resp.text}")
-    return resp.json()
+    try:
+        # orjson al posto di json: HEADERS ha già Content-Type: application/json
+        async with client.post(url, headers=HEADERS, data=orjson.dumps(payload), timeout=AIOHTTP_TIMEOUT) as resp:
+            if resp.status >= 400:
+                raise ShopifyError(f"POST {path} -> {resp.status}: {await resp.text()}", resp.status,
+                                   parse_retry_after(resp.headers.get("Retry-After")))
+            return orjson.loads(await resp.read())
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise ShopifyError(f"POST {path} -> {e!r}") from e
+
+async def graphql_async(client: aiohttp.ClientSession, query: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+    res = await api_post_async(client, "/graphql.json", {"query": query, "variables": variables})
+    errors = res.get("errors")
+    if errors:
+        # GraphQL risponde 200 anche quando il costo della query supera il bucket: lo tratto come un 429
+        throttled = any((err.get("extensions") or {}).get("code") == "THROTTLED" for err in errors if isinstance(err, dict))
+        raise ShopifyError(f"GraphQL -> {errors}", 429 if throttled else 200)
+    return res.get("data", {})
 
 # -----------------------
 # UI – Sidebar
@@ -99,19 +172,24 @@ with st.sidebar:
     inventory_policy = st.selectbox("Inventory policy", options=["deny", "continue"], index=0, help="Se esaurito: 'deny' blocca, 'continue' consente.")
     inventory_qty_default = st.number_input("Quantità inventario di default", min_value=0, value=0, step=1)
     max_images_per_product = st.number_input("Max immagini per prodotto", min_value=0, value=10, step=1, help="Per ridurre tempi e timeout.")
-    st.caption("Le immagini sono abbinate per **SKU** o **Handle URL** (il filename contiene SKU o handle).")
+    substring_match = st.checkbox("Abbinamento immagini per sottostringa (lento)", value=False, help="Se SKU/handle non corrisponde a una parola o a un prefisso del filename, cerca SKU/handle dentro tutti i nomi file. Scorre l'intero ZIP per ogni prodotto senza corrispondenze (anche quelli senza immagini).")
+    st.caption("Le immagini sono abbinate per **SKU** o **Handle URL** (il filename contiene SKU o handle come parola o prefisso, es. `sku_1.jpg`, `handle-2.png`).")
     if st.button("Test connessione Shopify"):
         try:
             info = api_get("/shop.json")
             st.success(f"Connessione OK · Shop: {info.get('shop', {}).get('name', 'sconosciuto')}")
         except Exception as e:
             st.error(f"Connessione fallita: {e}")
+    if st.button("Svuota cache prodotti creati"):
+        with shelve.open(CACHE_PATH) as cache:
+            cache.clear()
+        st.success("Cache svuotata.")
 
 # -----------------------
 # UI – Main
 # -----------------------
 st.title("CSV → Shopify + Immagini .zip (anti-timeout)")
-st.write("L’app crea prima il prodotto **senza immagini** e poi carica le immagini **una per una** per evitare timeout.")
+st.write("L’app crea prima il prodotto **senza immagini** e poi carica le immagini **in parallelo** (concorrenza limitata) per evitare timeout.")
 
 csv_file = st.file_uploader("Carica CSV", type=["csv"])
 zip_file = st.file_uploader("Carica immagini (.zip)", type=["zip"])
@@ -119,12 +197,26 @@ zip_file = st.file_uploader("Carica immagini (.zip)", type=["zip"])
 st.markdown("**Colonne attese nel CSV:** `Titolo Prodotto`, `SKU`, `Descrizione`, `Collezioni`, `Tag`, `Titolo della pagina`, `Meta descrizione`, `Handle URL`.")
 st.caption("Se mancano colonne, l'app usa fallback sensati (es. handle generato).")
 
-if csv_file:
+# Colonne testuali lette come stringhe (motore C): "00123" resta "00123", niente float('nan').
+# keep_default_na=False: celle vuote → "" e testi come "NA"/"null" restano testo; le righe corte
+# ricevono NaN nelle colonne mancanti, come prima.
+CSV_DTYPES = {c: "string" for c in [
+    "Titolo Prodotto", "SKU", "Descrizione", "Collezioni", "Tag", "Titolo della pagina", "Meta descrizione", "Handle URL",
+]}
+
+def read_csv(f, encoding: str = "utf-8") -> pd.DataFrame:
+    return pd.read_csv(f, dtype=CSV_DTYPES, keep_default_na=False, encoding=encoding)
+
+# Memoizzato sui byte del file: cambiare un'impostazione nella sidebar non rilegge il CSV
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_csv(data: bytes) -> pd.DataFrame:
     try:
-        df = pd.read_csv(csv_file)
+        return read_csv(io.BytesIO(data))
     except UnicodeDecodeError:
-        csv_file.seek(0)
-        df = pd.read_csv(csv_file, encoding="latin-1")
+        return read_csv(io.BytesIO(data), encoding="latin-1")
+
+if csv_file:
+    df = load_csv(csv_file.getvalue())
     st.subheader("Anteprima CSV")
     st.dataframe(df.head(20), use_container_width=True)
 else:
@@ -133,53 +225,427 @@ else:
 # -----------------------
 # ZIP → mappa immagini
 # -----------------------
-def build_image_index_from_zip(zf: zipfile.ZipFile) -> Dict[str, bytes]:
+def build_image_index_from_zip(zf: zipfile.ZipFile) -> Dict[str, zipfile.ZipInfo]:
+    # Solo metadati: i byte vengono letti al primo abbinamento
     supported_ext = (".jpg", ".jpeg", ".png", ".gif", ".webp")
     index = {}
-    for name in zf.namelist():
-        if name.lower().endswith(supported_ext) and not name.endswith("/"):
-            with zf.open(name) as f:
-                index[name.split('/')[-1].lower()] = f.read()
+    for info in zf.infolist():
+        if info.filename.lower().endswith(supported_ext) and not info.is_dir():
+            # chiave già in casefold: il matching non rinormalizza i filename a ogni prodotto
+            index[info.filename.split('/')[-1].casefold()] = info
     return index
 
-def find_images_for_product(index: Dict[str, bytes], keys: List[str]) -> List[Dict[str, Any]]:
-    found = []
-    keys = [k.lower() for k in keys if k]
-    for fname, content in index.items():
-        if any(k in fname for k in keys):
-            b64 = base64.b64encode(content).decode("utf-8")
-            found.append({"attachment": b64, "filename": fname})
-    return found
+ZIP_READ_WORKERS = os.cpu_count() or 4
+_zip_local = threading.local()
+
+def read_image(zip_bytes: bytes, info: zipfile.ZipInfo) -> bytes:
+    # Gira nel thread pool (zlib rilascia il GIL): un ZipFile per thread, perché lo stesso
+    # oggetto non è sicuro tra thread. Letta solo se non è già sullo storage di Shopify.
+    if getattr(_zip_local, "src", None) is not zip_bytes:
+        _zip_local.zf = zipfile.ZipFile(io.BytesIO(zip_bytes))
+        _zip_local.src = zip_bytes
+    return _zip_local.zf.read(info)
+
+_FILENAME_SEP_RE = re.compile(r"[-_.\s]+")
+
+def build_token_index(index: Dict[str, zipfile.ZipInfo]) -> Dict[str, List[str]]:
+    # token del filename (+ nome intero, stem e prefissi fino a ogni separatore) → filenames
+    # es. "abc-1_front.jpg" → abc, 1, front, jpg, abc-1, abc-1_front, abc-1_front.jpg
+    token_index: Dict[str, List[str]] = {}
+    for fname in index:
+        stem = fname.rsplit(".", 1)[0]
+        entries = {fname, stem}
+        entries.update(t for t in _FILENAME_SEP_RE.split(fname) if t)
+        entries.update(stem[:m.start()] for m in _FILENAME_SEP_RE.finditer(stem) if m.start())
+        for tok in entries:
+            token_index.setdefault(tok, []).append(fname)
+    return token_index
+
+# Memoizzato sui byte dello ZIP: i rerun di Streamlit non reindicizzano le stesse immagini
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_zip_index(zip_bytes: bytes) -> Tuple[Dict[str, zipfile.ZipInfo], Dict[str, List[str]]]:
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zf:
+        image_index = build_image_index_from_zip(zf)
+    return image_index, build_token_index(image_index)
+
+def find_images_for_product(index: Dict[str, zipfile.ZipInfo], token_index: Dict[str, List[str]],
+                            keys_cf: Tuple[str, ...], substring_fallback: bool = False) -> List[Dict[str, Any]]:
+    # keys_cf: SKU/handle già in casefold, come le chiavi di index e token_index.
+    # Di default O(len(keys_cf)) lookup per prodotto.
+    candidates = set()
+    for k in keys_cf:
+        candidates.update(token_index.get(k, []))
+    if not candidates and substring_fallback:
+        # opt-in: chiave contenuta a metà di un token (vecchio match per sottostringa).
+        # Costa O(immagini) per ogni prodotto senza match, quindi O(prodotti × immagini) nel caso peggiore.
+        candidates = {fname_cf for fname_cf in index if any(k in fname_cf for k in keys_cf)}
+    return [{
+        "filename": fname,
+        "info": index[fname],
+        "mime_type": mimetypes.guess_type(fname)[0] or "image/jpeg",
+    } for fname in sorted(candidates)]
 
 # -----------------------
-# Creazione prodotto
+# CSV → righe prodotto (preparazione vettoriale)
 # -----------------------
-@retry(
-    reraise=True,
-    stop=stop_after_attempt(4),
-    wait=wait_exponential(multiplier=1, min=2, max=20),
-    retry=retry_if_exception_type(ShopifyError),
-)
-def create_product(payload: Dict[str, Any]) -> Dict[str, Any]:
-    return api_post("/products.json", {"product": payload})
-
-@retry(
-    reraise=True,
-    stop=stop_after_attempt(4),
-    wait=wait_exponential(multiplier=1, min=2, max=20),
-    retry=retry_if_exception_type(ShopifyError),
-)
-def attach_image(product_id: int, image_payload: Dict[str, Any]) -> Dict[str, Any]:
-    return api_post(f"/products/{product_id}/images.json", {"image": image_payload})
+def product_cache_key(sku: str, title: str, body_html: str, handle: Optional[str]) -> str:
+    # SHOPIFY_STORE nella chiave: passando da uno store all'altro (dev → prod) non si salta nulla
+    raw = json.dumps([SHOPIFY_STORE, sku, title, body_html, handle], sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def prepare_rows(df: pd.DataFrame) -> pd.DataFrame:
+    # fillna solo sulle colonne usate (NaN delle righe corte), le altre restano com'erano
+    def col(name: str) -> pd.Series:
+        if name not in df.columns:
+            return pd.Series("", index=df.index)
+        return df[name].fillna("").astype(str).str.strip()
+
+    rows = pd.DataFrame(index=df.index)
+    rows["title"] = col("Titolo Prodotto")
+    rows["sku"] = col("SKU")
+    rows["body_html"] = col("Descrizione")
+    rows["tags"] = col("Tag").str.split(",").map(lambda xs: ", ".join(t.strip() for t in xs if t.strip()))
+    rows["seo_title"] = col("Titolo della pagina")
+    rows["seo_desc"] = col("Meta descrizione")
+    handle = col("Handle URL")
+    missing = handle == ""
+    handle[missing] = rows.loc[missing, "title"].map(lambda t: _slug(t) if t else "")
+    rows["handle"] = handle
+    return rows
 
-def update_product_metafields(product_id: int, seo_title: Optional[str], seo_desc: Optional[str]) -> None:
-    update = {"product": {}}
+# -----------------------
+# Creazione prodotto
+# -----------------------
+@shopify_retry
+async def create_product_async(client: aiohttp.ClientSession, payload: Dict[str, Any]) -> Dict[str, Any]:
+    return await api_post_async(client, "/products.json", {"product": payload})
+
+STAGED_UPLOADS_CREATE = """
+mutation stagedUploadsCreate($input: [StagedUploadInput!]!) {
+  stagedUploadsCreate(input: $input) {
+    stagedTargets { url resourceUrl parameters { name value } }
+    userErrors { field message }
+  }
+}
+"""
+
+PRODUCT_CREATE_MEDIA = """
+mutation productCreateMedia($productId: ID!, $media: [CreateMediaInput!]!) {
+  productCreateMedia(productId: $productId, media: $media) {
+    media { alt }
+    mediaUserErrors { field message }
+  }
+}
+"""
+
+@shopify_retry
+async def staged_uploads_create_async(client: aiohttp.ClientSession, images: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    data = await graphql_async(client, STAGED_UPLOADS_CREATE, {"input": [{
+        "filename": img["filename"],
+        "mimeType": img["mime_type"],
+        "fileSize": str(img["info"].file_size),
+        "resource": "IMAGE",
+        "httpMethod": "POST",
+    } for img in images]})
+    payload = data.get("stagedUploadsCreate") or {}
+    if payload.get("userErrors"):
+        raise ShopifyError(f"stagedUploadsCreate -> {payload['userErrors']}", 200)
+    return payload.get("stagedTargets") or []
+
+@shopify_retry
+async def upload_to_staged_target(client: aiohttp.ClientSession, target: Dict[str, Any], img: Dict[str, Any], content: bytes) -> str:
+    # Byte grezzi direttamente sullo storage di Shopify: niente base64 né header Admin API
+    form = aiohttp.FormData()
+    for p in target.get("parameters", []):
+        form.add_field(p["name"], p["value"])
+    form.add_field("file", content, filename=img["filename"], content_type=img["mime_type"])
+    try:
+        async with client.post(target["url"], data=form, timeout=AIOHTTP_TIMEOUT) as resp:
+            if resp.status >= 400:
+                raise ShopifyError(f"Staged upload {img['filename']} -> {resp.status}: {await resp.text()}", resp.status)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise ShopifyError(f"Staged upload {img['filename']} -> {e!r}") from e
+    return target["resourceUrl"]
+
+@shopify_retry
+async def product_create_media_async(client: aiohttp.ClientSession, product_id: int, resource_urls: List[str]) -> List[Dict[str, Any]]:
+    data = await graphql_async(client, PRODUCT_CREATE_MEDIA, {
+        "productId": f"gid://shopify/Product/{product_id}",
+        "media": [{"originalSource": url, "mediaContentType": "IMAGE"} for url in resource_urls],
+    })
+    return (data.get("productCreateMedia") or {}).get("mediaUserErrors") or []
+
+async def attach_images_async(client: aiohttp.ClientSession, load_image: Callable[[zipfile.ZipInfo], Awaitable[bytes]],
+                              staged_urls: Dict[str, asyncio.Future],
+                              product_id: int, images: List[Dict[str, Any]]) -> Tuple[List[str], Dict[str, str]]:
+    # 1 stagedUploadsCreate, N upload in parallelo, 1 productCreateMedia → (filename allegati, {filename: errore}).
+    # staged_urls: filename → Future del resourceUrl, registrato PRIMA dell'upload. Un file già caricato
+    # (o in caricamento) per un altro prodotto si attende e si riusa: si passa solo l'URL, non i byte.
+    failed: Dict[str, str] = {}
+    loop = asyncio.get_running_loop()
+    owned: Dict[str, asyncio.Future] = {}  # file che carica questo prodotto
+    futs: Dict[str, asyncio.Future] = {}
+    for img in images:
+        fname = img["filename"]
+        if fname not in staged_urls:
+            owned[fname] = staged_urls[fname] = loop.create_future()
+        futs[fname] = staged_urls[fname]
+    to_stage = [img for img in images if img["filename"] in owned]
+    try:
+        if to_stage:
+            targets, contents = await asyncio.gather(
+                staged_uploads_create_async(client, to_stage),
+                asyncio.gather(*[load_image(img["info"]) for img in to_stage]),
+            )
+            # Shopify dovrebbe restituire un target per input: quelli mancanti non vanno persi nel zip()
+            for img in to_stage[len(targets):]:
+                failed[img["filename"]] = "stagedUploadsCreate: nessun target restituito"
+            to_stage = to_stage[:len(targets)]
+            results = await asyncio.gather(
+                *[upload_to_staged_target(client, t, img, c) for t, img, c in zip(targets, to_stage, contents)],
+                return_exceptions=True,
+            )
+            for img, r in zip(to_stage, results):
+                if isinstance(r, ShopifyError):
+                    failed[img["filename"]] = str(r)
+                elif isinstance(r, BaseException):
+                    raise r
+                else:
+                    owned[img["filename"]].set_result(r)
+    finally:
+        # ogni Future creato qui va risolto (anche su eccezione), altrimenti chi lo attende resta bloccato.
+        # None = upload fallito: tolgo la voce così il prossimo prodotto che usa il file ritenta.
+        for fname, fut in owned.items():
+            if not fut.done():
+                fut.set_result(None)
+            if fut.result() is None:
+                staged_urls.pop(fname, None)
+
+    # Attendo anche i file caricati da altri worker; shield: se questo task viene cancellato
+    # non deve cancellare un Future condiviso.
+    urls = await asyncio.gather(*[asyncio.shield(futs[img["filename"]]) for img in images])
+    # (img, resourceUrl) nello stesso ordine dei media inviati
+    uploaded = []
+    for img, url in zip(images, urls):
+        if url is None:
+            failed.setdefault(img["filename"], "Upload staged fallito (file condiviso con un altro prodotto)")
+        elif img["filename"] not in failed:
+            uploaded.append((img, url))
+    if not uploaded:
+        return [], failed
+
+    errors = await product_create_media_async(client, product_id, [url for _, url in uploaded])
+    for err in errors:
+        # field = ["media", "<indice>", ...] quando l'errore riguarda un singolo media
+        field = err.get("field") or []
+        idx = int(field[1]) if len(field) > 1 and str(field[1]).isdigit() else None
+        if idx is not None and idx < len(uploaded):
+            failed[uploaded[idx][0]["filename"]] = err.get("message", "")
+        else:
+            for img, _ in uploaded:
+                failed.setdefault(img["filename"], err.get("message", ""))
+    # allegati = inviati a productCreateMedia e non rifiutati
+    attached = [img["filename"] for img, _ in uploaded if img["filename"] not in failed]
+    return attached, failed
+
+async def process_row(client: aiohttp.ClientSession, sem: asyncio.Semaphore, image_queue: asyncio.Queue,
+                      t: Tuple[Any, ...], col_idx: Dict[str, int], image_index: Dict[str, zipfile.ZipInfo],
+                      token_index: Dict[str, List[str]], cache: shelve.Shelf, seen_keys: set, product_template: Dict[str, Any],
+                      variant_template: Dict[str, Any], max_images: int, substring_fallback: bool,
+                      logs: List[Dict[str, Any]]) -> bool:
+    # Ritorna True se la riga è stata accodata alle immagini: in quel caso la chiude image_worker.
+    # t: tupla di itertuples(index=True, name=None) → t[0] indice CSV, col_idx dà la posizione delle colonne
+    i = t[0]
+    title = t[col_idx["title"]]
+    sku = t[col_idx["sku"]]
+    body_html = t[col_idx["body_html"]]
+    seo_title = t[col_idx["seo_title"]]
+    seo_desc = t[col_idx["seo_desc"]]
+    handle = t[col_idx["handle"]] or None
+
+    if not title:
+        logs.append({"row": i, "title": title, "sku": sku, "status": "skipped", "reason": "Titolo mancante"})
+        return False
+
+    # Pre-calc immagini ma NON le invio durante la creazione prodotto
+    images_found = []
+    if image_index:
+        keys_cf = tuple(k.casefold() for k in (sku, handle) if k)
+        images_found = find_images_for_product(image_index, token_index, keys_cf, substring_fallback)
+        if max_images and len(images_found) > max_images:
+            images_found = images_found[:max_images]
+
+    cache_key = product_cache_key(sku, title, body_html, handle)
+    if cache_key in seen_keys:
+        # riga duplicata nello stesso CSV: prodotto e immagini sono già gestiti dalla prima occorrenza
+        logs.append({"row": i, "title": title, "sku": sku, "status": "skipped", "reason": "Riga duplicata"})
+        return False
+    seen_keys.add(cache_key)
+    cached = cache.get(cache_key)
+    if cached:
+        # prodotto già creato: non lo ricreo, ma riaccodo le immagini non ancora allegate
+        pending = [img for img in images_found if img["filename"] not in cached["images"]]
+        entry = {
+            "row": i,
+            "title": title,
+            "sku": sku,
+            "product_id": cached["product_id"],
+            "status": "skipped",
+            "reason": "Già creato (cache): ritento le immagini mancanti" if pending else "Già creato (cache)",
+            "images_attached": 0,
+        }
+        logs.append(entry)
+        if pending:
+            await image_queue.put((entry, pending, cache_key))
+        return bool(pending)
+
+    variant = {**variant_template, "sku": sku if sku else None}
+
+    # === 1) CREA PRODOTTO SENZA IMMAGINI (payload leggero) ===
+    product_payload = {
+        **product_template,
+        "title": title,
+        "body_html": body_html,
+        "tags": t[col_idx["tags"]] or None,
+        "variants": [variant],
+    }
+    if handle:
+        product_payload["handle"] = handle
+    # SEO nello stesso POST di creazione: niente PUT successivo
     if seo_title:
-        update["product"]["metafields_global_title_tag"] = seo_title[:70]
+        product_payload["metafields_global_title_tag"] = seo_title[:70]
     if seo_desc:
-        update["product"]["metafields_global_description_tag"] = seo_desc[:320]
-    if update["product"]:
-        api_put(f"/products/{product_id}.json", update)
+        product_payload["metafields_global_description_tag"] = seo_desc[:320]
+
+    async with sem:
+        try:
+            res = await create_product_async(client, product_payload)
+            prod = res.get("product", {})
+            product_id = prod.get("id")
+            if not product_id:
+                raise ShopifyError(f"POST /products.json -> risposta senza id prodotto: {str(res)[:200]}", 200)
+            cache[cache_key] = {"product_id": product_id, "images": []}
+        except ShopifyError as e:
+            logs.append({
+                "row": i,
+                "title": title,
+                "sku": sku,
+                "status": "error",
+                "error": str(e)[:500],
+            })
+            return False
+
+    entry = {
+        "row": i,
+        "title": title,
+        "sku": sku,
+        "product_id": product_id,
+        "handle": prod.get("handle"),
+        "status": "created",
+        "images_attached": 0,
+    }
+    logs.append(entry)
+
+    # === 2) ACCODA LE IMMAGINI: i worker le allegano mentre passo alla riga successiva ===
+    if images_found:
+        await image_queue.put((entry, images_found, cache_key))
+    return bool(images_found)
+
+async def image_worker(client: aiohttp.ClientSession, image_queue: asyncio.Queue,
+                       load_image: Callable[[zipfile.ZipInfo], Awaitable[bytes]], staged_urls: Dict[str, asyncio.Future],
+                       cache: shelve.Shelf, on_row_done: Callable[[], None], logs: List[Dict[str, Any]]) -> None:
+    while True:
+        entry, images, cache_key = await image_queue.get()
+        try:
+            try:
+                attached, failed = await attach_images_async(client, load_image, staged_urls, entry["product_id"], images)
+            except Exception as e:
+                # qualsiasi errore (ShopifyError, zlib.error da un entry corrotto, KeyError, ...) finisce nel
+                # log: un worker che esce lascerebbe image_queue.put/join bloccati per sempre
+                attached, failed = [], {img["filename"]: f"{type(e).__name__}: {e}" for img in images}
+            entry["images_attached"] = len(attached)
+            if attached:
+                # solo le immagini allegate davvero: le altre vengono ritentate al prossimo run
+                cached = cache[cache_key]
+                cache[cache_key] = {**cached, "images": cached["images"] + attached}
+            for filename, error in failed.items():
+                logs.append({
+                    "row": entry["row"],
+                    "title": entry["title"],
+                    "sku": entry["sku"],
+                    "product_id": entry["product_id"],
+                    "status": "image_error",
+                    "error": error[:300],
+                    "filename": filename
+                })
+        finally:
+            image_queue.task_done()
+            on_row_done()
+
+async def run_upload(df: pd.DataFrame, zip_bytes: Optional[bytes], image_index: Dict[str, zipfile.ZipInfo],
+                     token_index: Dict[str, List[str]], cache: shelve.Shelf, progress) -> List[Dict[str, Any]]:
+    logs: List[Dict[str, Any]] = []
+    total = len(df)
+    done = 0
+    shown = 0.0  # ultima frazione inviata alla UI
+    # Campi uguali per tutte le righe: calcolati una volta sola
+    product_template = {
+        "vendor": default_vendor,
+        "product_type": default_product_type,
+        "status": default_status,
+    }
+    variant_template = {
+        "price": str(default_price),
+        "inventory_policy": inventory_policy,
+        "inventory_management": "shopify",
+        "inventory_quantity": int(inventory_qty_default),
+        "requires_shipping": True,
+        "taxable": True
+    }
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    image_queue: asyncio.Queue = asyncio.Queue(maxsize=IMAGE_QUEUE_SIZE)
+    # keep-alive lungo: le connessioni TLS verso lo store vengono riusate tra le richieste
+    connector = aiohttp.TCPConnector(limit=64, limit_per_host=16, keepalive_timeout=75, enable_cleanup_closed=True)
+    rows = prepare_rows(df)
+    # +1: in itertuples(index=True) la posizione 0 è l'indice
+    col_idx = {c: n + 1 for n, c in enumerate(rows.columns)}
+    zip_pool = ThreadPoolExecutor(max_workers=ZIP_READ_WORKERS)
+    load_image = functools.partial(asyncio.get_running_loop().run_in_executor, zip_pool, read_image, zip_bytes)
+    async with aiohttp.ClientSession(connector=connector) as client:
+        staged_urls: Dict[str, asyncio.Future] = {}  # filename → Future del resourceUrl in questo run
+        seen_keys: set = set()  # chiavi cache già elaborate in questo run
+
+        def on_row_done() -> None:
+            # riga conclusa (creazione + eventuali immagini); ogni update è un frame websocket:
+            # aggiorno la barra solo a passi dell'1%
+            nonlocal done, shown
+            done += 1
+            frac = done / total
+            if frac - shown >= 0.01 or done == total:
+                progress.progress(frac)
+                shown = frac
+
+        workers = [asyncio.create_task(image_worker(client, image_queue, load_image, staged_urls, cache, on_row_done, logs))
+                   for _ in range(IMAGE_WORKERS)]
+
+        async def run(t):
+            queued = await process_row(client, sem, image_queue, t, col_idx, image_index, token_index, cache, seen_keys,
+                                       product_template, variant_template, int(max_images_per_product), substring_match, logs)
+            if not queued:
+                on_row_done()
+
+        try:
+            # tuple semplici, niente Series/namedtuple/dict per riga (gather crea comunque tutte le coroutine subito)
+            await asyncio.gather(*(run(t) for t in rows.itertuples(index=True, name=None)))
+            await image_queue.join()
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            zip_pool.shutdown(wait=False)
+    # i task completano in ordine sparso: riordino il log per riga CSV
+    logs.sort(key=lambda r: r["row"])
+    return logs
 
 # -----------------------
 # Go!
@@ -189,11 +655,13 @@ if st.button("Crea prodotti su Shopify", type="primary", disabled=(df is None)):
         st.error("Carica prima un CSV.")
         st.stop()
 
+    zip_bytes = None
     image_index = {}
+    token_index = {}
     if zip_file:
         try:
-            with zipfile.ZipFile(zip_file) as zf:
-                image_index = build_image_index_from_zip(zf)
+            zip_bytes = zip_file.getvalue()
+            image_index, token_index = load_zip_index(zip_bytes)
             st.success(f"Immagini indicizzate: {len(image_index)} file.")
         except zipfile.BadZipFile:
             st.error("Il file ZIP non è valido.")
@@ -204,105 +672,9 @@ if st.button("Crea prodotti su Shopify", type="primary", disabled=(df is None)):
         if col not in df.columns:
             st.warning(f"Colonna mancante nel CSV: **{col}**")
 
-    logs = []
     progress = st.progress(0.0)
-    total = len(df)
-
-    for i, row in df.iterrows():
-        title = str(row.get("Titolo Prodotto", "")).strip()
-        sku = str(row.get("SKU", "")).strip()
-        body_html = str(row.get("Descrizione", "")).strip()
-
-        collections = str(row.get("Collezioni", "") or "").strip()
-        tags = str(row.get("Tag", "") or "").strip()
-        seo_title = str(row.get("Titolo della pagina", "") or "").strip()
-        seo_desc  = str(row.get("Meta descrizione", "") or "").strip()
-        handle    = str(row.get("Handle URL", "") or "").strip() or (slugify(title) if title else None)
-
-        if not title:
-            logs.append({"row": i, "title": title, "sku": sku, "status": "skipped", "reason": "Titolo mancante"})
-            progress.progress((i + 1) / total)
-            continue
-
-        variant = {
-            "sku": sku if sku else None,
-            "price": str(default_price),
-            "inventory_policy": inventory_policy,
-            "inventory_management": "shopify",
-            "inventory_quantity": int(inventory_qty_default),
-            "requires_shipping": True,
-            "taxable": True
-        }
-
-        tag_list = [t.strip() for t in tags.split(",") if t.strip()]
-        tags_str = ", ".join(tag_list) if tag_list else None
-
-        # Pre-calc immagini ma NON le invio durante la creazione prodotto
-        images_found = []
-        if image_index:
-            keys = [k for k in [sku, handle] if k]
-            images_found = find_images_for_product(image_index, keys)
-            if max_images_per_product and len(images_found) > max_images_per_product:
-                images_found = images_found[:max_images_per_product]
-
-        # === 1) CREA PRODOTTO SENZA IMMAGINI (payload leggero) ===
-        product_payload = {
-            "title": title,
-            "body_html": body_html,
-            "vendor": default_vendor,
-            "product_type": default_product_type,
-            "status": default_status,
-            "tags": tags_str,
-            "variants": [variant],
-        }
-        if handle:
-            product_payload["handle"] = handle
-
-        try:
-            res = create_product(product_payload)
-            prod = res.get("product", {})
-            product_id = prod.get("id")
-            try:
-                update_product_metafields(product_id, seo_title, seo_desc)
-            except ShopifyError as e:
-                st.info(f"SEO non aggiornato per {title}: {e}")
-
-            # === 2) ALLEGA IMMAGINI UNA AD UNA ===
-            attached = 0
-            for img in images_found:
-                try:
-                    attach_image(product_id, img)
-                    attached += 1
-                except ShopifyError as e:
-                    logs.append({
-                        "row": i,
-                        "title": title,
-                        "sku": sku,
-                        "product_id": product_id,
-                        "status": "image_error",
-                        "error": str(e)[:300],
-                        "filename": img.get("filename")
-                    })
-
-            logs.append({
-                "row": i,
-                "title": title,
-                "sku": sku,
-                "product_id": product_id,
-                "handle": prod.get("handle"),
-                "status": "created",
-                "images_attached": attached,
-            })
-        except ShopifyError as e:
-            logs.append({
-                "row": i,
-                "title": title,
-                "sku": sku,
-                "status": "error",
-                "error": str(e)[:500],
-            })
-
-        progress.progress((i + 1) / total)
+    with shelve.open(CACHE_PATH) as cache:
+        logs = asyncio.run(run_upload(df, zip_bytes, image_index, token_index, cache, progress))
 
     log_df = pd.DataFrame(logs)
     st.subheader("Risultati")